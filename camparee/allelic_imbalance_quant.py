@@ -127,8 +127,8 @@ class AllelicImbalanceQuantificationStep(AbstractCampareeStep):
                     continue
 
                 # Obtain the edit distance information for the forward read
-                fwd_NM_match = re.search(num_mismatches_pattern, forward)
-                rev_NM_match = re.search(num_mismatches_pattern, reverse)
+                fwd_NM_match = num_mismatches_pattern.search(forward)
+                rev_NM_match = num_mismatches_pattern.search(reverse)
                 if fwd_NM_match and rev_NM_match:
                     fwd_NM_count = int(fwd_NM_match.group(2))
                     rev_NM_count = int(rev_NM_match.group(2))
@@ -99,6 +99,7 @@ class Intron(TranscriptRegion):
         TranscriptRegion.__init__(self, *args)
         self.mintrons = [] # List of all mintrons that this overlaps
         self.antisense_mintrons = [] # List of mintrons on the other strand that aren't sense for something else
+        self.index = None # Position in AnnotationInfo.introns
 
 
 class Mintron(Region):
@@ -120,7 +121,7 @@ class AnnotationInfo:
      Stores genes, transcripts, intergenic regions, and exons both for easy access by ID and for quick lookup by
      position, using sorted lists by start position, allowing binary search."""
 
-    def __init__(self, geneinfo_file_path, chrom_lengths, flank_size=1500):
+    def __init__(self, geneinfo_file_path, chrom_lengths, flank_size=1500, restrict_chroms=None):
         """
         Load geneinfo file as a large datastructure containing all the information
         geneinfo file is in the bed format with 1-based, inclusive coordinates for ranges
@@ -128,6 +129,9 @@ class AnnotationInfo:
 
         :param geneinfo_file_path: file path to find the geneinfo file
         :param chrom_lengths: dictionary of {chromosome -> chromosome lengths}, obtainable from header of a SAM/BAM file
+        :param restrict_chroms: chromosomes to compute the mintrons and the region lookups for, or None for all of
+                                them. Genes and transcripts of other chromosomes are still loaded, but their introns
+                                overlap no mintrons, so they have no effective length.
         """
         self.chrom_lengths = chrom_lengths
 
@@ -193,7 +197,8 @@ class AnnotationInfo:
         # Compute the mintrons and their inclusions
         # mintrons are each region that is neither intergenic nor exonic - pieces of intron
         intergenic_and_exonic = {(chrom, strand): sorted(itertools.chain(self.intergenics[chrom], self.merged_exons[chrom, strand]), key=lambda x: x.start)
-                                 for chrom, strand in self.merged_exons}
+                                 for chrom, strand in self.merged_exons
+                                 if restrict_chroms is None or chrom in restrict_chroms}
         self.intergenic_and_exonic = self.merge_regions(intergenic_and_exonic)
         self.mintrons_by_chrom = self.complement_regions(self.intergenic_and_exonic, cls=Mintron)
 
@@ -203,10 +208,13 @@ class AnnotationInfo:
                                          for (chrom, strand), mintrons in self.mintrons_by_chrom.items()}
         self.intergenic_extents_by_chrom = {chrom: (numpy.array([intergenic.start for intergenic in intergenics]),
                                                     numpy.array([intergenic.end for intergenic in intergenics]))
-                                            for chrom, intergenics in self.intergenics.items()}
+                                            for chrom, intergenics in self.intergenics.items()
+                                            if restrict_chroms is None or chrom in restrict_chroms}
 
         # Give mintrons their annotations
         for (chrom, strand), transcripts in self.transcripts_by_chrom.items():
+            if (chrom, strand) not in self.mintrons_by_chrom:
+                continue # Chromosome left out by restrict_chroms
             mintrons = self.mintrons_by_chrom[chrom, strand]
             mintron_starts = numpy.array([m.start for m in mintrons])
             for transcript in transcripts:
@@ -297,17 +305,70 @@ class AnnotationInfo:
                             pass
                             # Do nothing since the mintron already has sense annotations, don't give it any anti-sense
 
-            # Compute effective lengths of each intron
-            for transcript in self.transcripts.values():
+        # All introns (including flanks) numbered densely, so that per-intron values can be kept in numpy arrays
+        self.introns = [intron for transcript in self.transcripts.values() for intron in transcript.introns]
+        for index, intron in enumerate(self.introns):
+            intron.index = index
+
+        # Compute effective lengths of each intron
+        for intron in self.introns:
+            intron.effective_length = 0
+            for mintron in intron.mintrons:
+                intron.effective_length += mintron.end - mintron.start + 1
+            intron.antisense_effective_length = 0
+            for mintron in intron.antisense_mintrons:
+                intron.antisense_effective_length += mintron.end - mintron.start + 1
+        self.intron_effective_lengths = numpy.array([intron.effective_length for intron in self.introns],
+                                                    dtype=numpy.float64)
+        self.intron_antisense_effective_lengths = numpy.array([intron.antisense_effective_length for intron in self.introns],
+                                                              dtype=numpy.float64)
+
+        # The non-flank introns of each transcript of self.transcript_ids, in compressed sparse row form: those of
+        # transcript i are self.transcript_intron_indices[self.transcript_intron_indptr[i]:self.transcript_intron_indptr[i+1]]
+        self.transcript_ids = list(self.transcripts)
+        self.transcript_intron_indices = numpy.array([intron.index for transcript in self.transcripts.values()
+                                                      for intron in transcript.introns[1:-1]], dtype=numpy.int64)
+        self.transcript_intron_indptr = numpy.cumsum([0] + [len(transcript.introns[1:-1])
+                                                            for transcript in self.transcripts.values()])
+
+        # For each mintron, the indexes of its primary introns, as parallel arrays of (mintron index, intron index)
+        self.primary_intron_ids_by_chrom = {contig: self.intron_ids(mintrons, "primary_introns")
+                                            for contig, mintrons in self.mintrons_by_chrom.items()}
+        self.primary_antisense_intron_ids_by_chrom = {contig: self.intron_ids(mintrons, "primary_antisense_introns")
+                                                      for contig, mintrons in self.mintrons_by_chrom.items()}
+
+        # For each intron index, the indexes of the primary introns of the mintrons it overlaps but is not primary
+        # for itself. Introns are in order of their transcript's start, which is the order their counts get corrected in.
+        self.sense_conflicts = dict()
+        self.antisense_conflicts = dict()
+        for transcripts in self.transcripts_by_chrom.values():
+            for transcript in transcripts:
                 for intron in transcript.introns:
-                    intron.effective_length = 0
-                    for mintron in intron.mintrons:
-                        intron.effective_length += mintron.end - mintron.start + 1
-                    intron.antisense_effective_length = 0
-                    for mintron in intron.antisense_mintrons:
-                        intron.antisense_effective_length += mintron.end - mintron.start + 1
-
+                    sense_conflicts = [other_intron.index for mintron in intron.mintrons
+                                       if intron not in mintron.primary_introns
+                                       for other_intron in mintron.primary_introns]
+                    if sense_conflicts:
+                        self.sense_conflicts[intron.index] = sense_conflicts
+                    antisense_conflicts = [other_intron.index for mintron in intron.antisense_mintrons
+                                           if intron not in mintron.primary_antisense_introns
+                                           for other_intron in mintron.primary_antisense_introns]
+                    if antisense_conflicts:
+                        self.antisense_conflicts[intron.index] = antisense_conflicts
+
+
+    @staticmethod
+    def intron_ids(mintrons, attribute):
+        """
+        Flatten the introns listed by each mintron into arrays suitable for numpy.add.at()
 
+        :param mintrons: mintrons of a chromosome/strand
+        :param attribute: name of the mintron attribute listing the introns, eg: "primary_introns"
+        :return: tuple of numpy arrays (mintron indexes, intron indexes), one entry for each intron of each mintron
+        """
+        mintron_indexes = [mintron_index for mintron_index, mintron in enumerate(mintrons)
+                           for intron in getattr(mintron, attribute)]
+        intron_indexes = [intron.index for mintron in mintrons for intron in getattr(mintron, attribute)]
+        return numpy.array(mintron_indexes, dtype=numpy.int64), numpy.array(intron_indexes, dtype=numpy.int64)
 
     def add_flanks(self, flank_size):
         """
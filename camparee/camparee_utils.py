@@ -1,7 +1,12 @@
 import re
 import os
+import io
 import gzip
-import itertools
+import mmap
+import shutil
+import signal
+import string
+import subprocess
 import pandas as pd
 
 class CampareeUtils:
@@ -9,8 +14,51 @@ class CampareeUtils:
     Utilities for steps in the CAMPAREE expression pipeline.
     """
 
+    # Size of the read/write buffers used for files opened with open_file().
+    # Much larger than the 8 KiB default, which cuts down on the number of
+    # system and zlib calls when streaming large reference files.
+    io_buffer_size = 1 << 17
+
+    # Regex to recognize FASTA header line and store chromosome/contig name
+    # (i.e. sequence identifier) in the first group. Chromosome/contig name
+    # defined as all non-space characters between ">" and the first whitespace
+    # character. FASTA files are processed in binary mode, so this is a bytes
+    # pattern.
+    fasta_header_pattern = re.compile(rb'>([^\s]*)')
+
+    # Size of the chunks in which create_oneline_seq_fasta() reads its input.
+    fasta_chunk_size = 1 << 20
+
+    # Translation table used to convert sequence data to uppercase with
+    # bytes.translate(), which avoids decoding and re-encoding the sequence.
+    # This is a single pass of C-level table lookups over the data, which was
+    # measured to be over ten times faster than uppercasing a numpy uint8 view
+    # of the same data with a vectorized mask-and-subtract.
+    uppercase_table = bytes.maketrans(string.ascii_lowercase.encode("ascii"),
+                                      string.ascii_uppercase.encode("ascii"))
+
+    # Regex patterns used to extract individual attributes from the 9th column
+    # in a GTF file (the "attributes" column). The first only extracts the
+    # transcript ID, the second extracts all attributes used in the annotation
+    # file (name in the first group, value in the second) in a single pass.
+    gtf_txid_pattern = re.compile(r'transcript_id "([^"]+)";')
+    gtf_attributes_pattern = re.compile(r'(transcript_id|gene_id|gene_name|gene_biotype) "([^"]+)";')
+
+    # Regex patterns used to parse lines of a CAMPAREE variants file: the first
+    # captures the chromosome, position and the string of variants that follows
+    # them, the second captures each variant description and its read count.
+    variant_line_pattern = re.compile(r'([^\t|]+):(\d+)((?: \| [^\s:|]+:\d+)*)\t')
+    variant_pattern = re.compile(r' \| ([^\s:|]+):(\d+)')
+
     # Line format definition for annotation file
     annot_output_format = '{chrom}\t{strand}\t{txStart}\t{txEnd}\t{exonCount}\t{exonStarts}\t{exonEnds}\t{transcriptID}\t{geneID}\t{geneSymbol}\t{biotype}\n'
+    # Positional equivalent of annot_output_format (same fields, in the same
+    # order) for use with the % operator, which skips the keyword argument
+    # handling of str.format() when writing large numbers of lines.
+    annot_output_template = '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\n'
+    # Number of annotation lines to collect before writing them to the
+    # annotation file in a single call.
+    annot_lines_per_write = 4096
 
     @staticmethod
     def create_oneline_seq_fasta(input_fasta_file_path, output_oneline_fasta_file_path):
@@ -36,38 +84,86 @@ class CampareeUtils:
         # handles duplicate removal.
         chromosomes = set()
 
-        # Build regex to recognize FASTA header line and store chromosome/contig
-        # name (i.e. sequence identifier) in the first group. Chromosome/contig
-        # name defined as all non-space characters between ">" and the first
-        # whitespace character.
-        fasta_header_pattern = re.compile(r'>([^\s]*).*')
+        fasta_header_match = CampareeUtils.fasta_header_pattern.match
+        uppercase_table = CampareeUtils.uppercase_table
 
         # Flag to denote when a FASTA sequence (and not a header) is being
         # processed.
         building_sequence = False
 
-        # Input FASTA lines saved directly to output file as they are processed
-        # to minimize the amount of data stored in memory at a given time.
-        with CampareeUtils.open_file(input_fasta_file_path, 'r') as input_fasta_file, \
-             CampareeUtils.open_file(output_oneline_fasta_file_path, 'w') as output_fasta_file:
+        # Flag to denote when the previous chunk ended in the middle of a
+        # sequence line, so the start of the next chunk is not the start of a
+        # line (and cannot be a header).
+        continuing_line = False
+
+        # Header line from the end of the previous chunk, held back until the
+        # next chunk completes it.
+        partial_header = b''
+
+        # Input FASTA data saved directly to output file as it is processed to
+        # minimize the amount of data stored in memory at a given time. Data are
+        # processed in large chunks (and in binary mode, so sequences never need
+        # to be decoded), with every run of sequence lines between two headers
+        # stripped of line breaks and written in a single call.
+        with CampareeUtils.open_file(input_fasta_file_path, 'rb') as input_fasta_file, \
+             CampareeUtils.open_file(output_oneline_fasta_file_path, 'wb') as output_fasta_file:
+
+            while True:
+                chunk = input_fasta_file.read(CampareeUtils.fasta_chunk_size)
+                if b'\r' in chunk:
+                    # Normalize '\r\n' and '\r' line breaks to '\n' (matching
+                    # universal newlines in text mode), making sure a '\r\n'
+                    # pair isn't split across two chunks.
+                    if chunk.endswith(b'\r'):
+                        chunk += input_fasta_file.read(1)
+                    chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+                data = partial_header + chunk if partial_header else chunk
+                partial_header = b''
+                if chunk:
+                    # Hold back the last line if it's an incomplete header.
+                    # Incomplete sequence lines can be processed right away.
+                    last_line_start = data.rfind(b'\n') + 1
+                    if data.startswith(b'>', last_line_start) and (last_line_start > 0 or not continuing_line):
+                        data, partial_header = data[:last_line_start], data[last_line_start:]
+
+                # Output for this chunk is collected and written with a single
+                # call, which matters for FASTA files with many short sequences.
+                output_data = []
+
+                position = 0
+                while position < len(data):
+                    if data.startswith(b'>', position) and (position > 0 or not continuing_line):
+                        if building_sequence:
+                            # Add newline at the end of previous sequence
+                            output_data.append(b'\n')
+                            building_sequence = False
+
+                        sequence_id = fasta_header_match(data, position).group(1)
+                        output_data.append(b'>' + sequence_id + b'\n')
+                        chromosomes.add(sequence_id.decode("ascii"))
+
+                        line_end = data.find(b'\n', position)
+                        position = len(data) if line_end == -1 else line_end + 1
 
-            for line in input_fasta_file:
-                if line.startswith(">"):
-                    if building_sequence:
-                        # Add newline at the end of previous sequence
-                        output_fasta_file.write('\n')
-                        building_sequence = False
+                    else:
+                        # Sequence continues up to the line break before the next
+                        # header (or the end of the data).
+                        sequence_end = data.find(b'\n>', position)
+                        sequence_end = len(data) if sequence_end == -1 else sequence_end + 1
+                        output_data.append(data[position:sequence_end].replace(b'\n', b'').translate(uppercase_table))
+                        building_sequence = True
+                        position = sequence_end
 
-                    sequence_id = re.match(fasta_header_pattern, line).group(1)
-                    output_fasta_file.write('>' + sequence_id + '\n')
-                    chromosomes.add(sequence_id)
+                    continuing_line = False
 
-                else:
-                    output_fasta_file.write(line.rstrip('\n').upper())
-                    building_sequence = True
+                output_fasta_file.writelines(output_data)
+
+                if not chunk:
+                    break
+                continuing_line = bool(data) and not data.endswith(b'\n')
 
             # Add line break to end of output oneline fasta file.
-            output_fasta_file.write("\n")
+            output_fasta_file.write(b"\n")
 
         return chromosomes
 
@@ -76,32 +172,144 @@ class CampareeUtils:
         """
         Creates a genome dictionary from the genome file located at the provided path
         (if compressed, it must have a gz extension).  The filename is assumed to contain the chr sequences without
-        line breaks.
+        line breaks. Uncompressed genome files are memory-mapped and each sequence is sliced directly out of the
+        mapping. For compressed genome files, if a FASTA index (a samtools faidx ".fai" file) exists alongside the
+        genome file, each sequence is read directly into a buffer preallocated to the length given by the index.
         :param genome_file_path: path to reference genome file (either compressed or not)
         :return: genome as a dictionary with the chromosomes/contigs as keys and the sequences as values.
         """
-        chr_pattern = re.compile(">([^\s]*).*")
+        if not genome_file_path.endswith('.gz'):
+            return CampareeUtils._create_genome_from_mapped_file(genome_file_path)
+
+        fasta_header_match = CampareeUtils.fasta_header_pattern.match
+        uppercase_table = CampareeUtils.uppercase_table
+        sequence_lengths = CampareeUtils.read_fasta_index_lengths(genome_file_path)
         genome = dict()
-        _, file_extension = os.path.splitext(genome_file_path)
-        if 'gz' in file_extension:
-            with gzip.open(genome_file_path, 'r') as genome_file:
-                for chr, seq in itertools.zip_longest(*[genome_file] * 2):
-                    chr_match = re.match(chr_pattern, chr.decode("ascii"))
-                    if not chr_match:
-                        raise CampareeUtilsException(f'Cannot parse the chromosome from the fasta line {chr}.')
-                    chr = chr_match.group(1)
-                    genome[chr] = seq.decode("ascii").rstrip().upper()
-        else:
-            with open(genome_file_path, 'r') as reference_genome_file:
-                with open(genome_file_path, 'r') as genome_file:
-                    for chr, seq in itertools.zip_longest(*[genome_file] * 2):
-                        chr_match = re.match(chr_pattern, chr)
-                        if not chr_match:
-                            raise CampareeUtilsException(f'Cannot parse the chromosome from the fasta line {chr}.')
-                        chr = chr_match.group(1)
-                        genome[chr] = seq.rstrip().upper()
+        # open_file function checks if file is gzipped and opens it appropriately.
+        with CampareeUtils.open_file(genome_file_path, 'rb') as genome_file:
+            # Read each header line and its sequence explicitly, rather than mixing
+            # file iteration with the readline()/readinto() calls below.
+            while True:
+                chr = genome_file.readline()
+                if not chr:
+                    break
+                chr_match = fasta_header_match(chr)
+                if not chr_match:
+                    raise CampareeUtilsException(f'Cannot parse the chromosome from the fasta line {chr}.')
+                chr = chr_match.group(1).decode("ascii")
+                sequence_length = sequence_lengths.get(chr)
+                if sequence_length is None:
+                    seq = genome_file.readline().rstrip()
+                else:
+                    seq = bytearray(sequence_length)
+                    # The rest of the line should only contain the line break.
+                    if CampareeUtils.read_into(genome_file, seq) < sequence_length or genome_file.readline().strip():
+                        raise CampareeUtilsException(f'The length of chromosome {chr} in {genome_file_path} does '
+                                                     f'not match the length given by its FASTA index.')
+                genome[chr] = seq.translate(uppercase_table).decode("ascii")
         return genome
 
+    @staticmethod
+    def _create_genome_from_mapped_file(genome_file_path):
+        """
+        Version of create_genome for uncompressed genome files, which scans a memory-mapped copy of the file instead
+        of reading it line by line. Only one bytes object is created per sequence, and the OS pages the sequence data
+        in on demand.
+        :param genome_file_path: path to uncompressed reference genome file
+        :return: genome as a dictionary with the chromosomes/contigs as keys and the sequences as values.
+        """
+        fasta_header_match = CampareeUtils.fasta_header_pattern.match
+        uppercase_table = CampareeUtils.uppercase_table
+        genome = dict()
+        # Empty files cannot be memory-mapped.
+        if os.path.getsize(genome_file_path) == 0:
+            return genome
+        with open(genome_file_path, 'rb') as genome_file, \
+                mmap.mmap(genome_file.fileno(), 0, access=mmap.ACCESS_READ) as genome_map:
+            file_size = len(genome_map)
+            position = 0
+            while position < file_size:
+                # Each header line is followed by a single line of sequence.
+                header_end = genome_map.find(b'\n', position)
+                header_end = file_size if header_end == -1 else header_end
+                chr_match = fasta_header_match(genome_map, position, header_end)
+                if not chr_match:
+                    raise CampareeUtilsException(f'Cannot parse the chromosome from the fasta line '
+                                                 f'{genome_map[position:header_end + 1]}.')
+                chr = chr_match.group(1).decode("ascii")
+                sequence_start = min(header_end + 1, file_size)
+                sequence_end = genome_map.find(b'\n', sequence_start)
+                sequence_end = file_size if sequence_end == -1 else sequence_end
+                genome[chr] = genome_map[sequence_start:sequence_end].rstrip().translate(uppercase_table).decode("ascii")
+                position = sequence_end + 1
+        return genome
+
+    @staticmethod
+    def read_fasta_index_lengths(genome_file_path):
+        """
+        Reads the sequence lengths from the FASTA index (a samtools faidx ".fai" file) of the given genome file, if
+        one exists.
+        :param genome_file_path: path to genome file (either compressed or not)
+        :return: dictionary with the chromosomes/contigs as keys and their sequence lengths as values. Empty if there
+        is no FASTA index for the genome file.
+        """
+        sequence_lengths = dict()
+        fasta_index_file_path = genome_file_path + '.fai'
+        if os.path.isfile(fasta_index_file_path):
+            with open(fasta_index_file_path, 'r') as fasta_index_file:
+                for line in fasta_index_file:
+                    chr, sequence_length, *_ = line.split('\t')
+                    sequence_lengths[chr] = int(sequence_length)
+        return sequence_lengths
+
+    @staticmethod
+    def read_into(input_file, buffer):
+        """
+        Fills a preallocated buffer with data read from a binary file object, avoiding the intermediate copies made
+        when reading large amounts of data with read() or readline().
+        :param input_file: file object opened in binary mode
+        :param buffer: writable buffer (e.g. a bytearray) to fill
+        :return: number of bytes read into the buffer, which is smaller than the size of the buffer only if the end of
+        the file was reached first.
+        """
+        buffer_view = memoryview(buffer)
+        bytes_read = 0
+        while bytes_read < len(buffer_view):
+            count = input_file.readinto(buffer_view[bytes_read:])
+            if not count:
+                break
+            bytes_read += count
+        return bytes_read
+
+    @staticmethod
+    def iter_genome(genome_file_path):
+        """
+        Iterates over the chromosomes/contigs in the genome file located at the provided path (if compressed, it must
+        have a gz extension), without holding their sequences in memory. Unlike create_genome, sequences may contain
+        line breaks.
+        :param genome_file_path: path to reference genome file (either compressed or not)
+        :return: generator of (chromosome/contig, sequence length) tuples, in the order they appear in the file.
+        """
+        fasta_header_match = CampareeUtils.fasta_header_pattern.match
+        chr = None
+        sequence_length = 0
+        with CampareeUtils.open_file(genome_file_path, 'rb') as genome_file:
+            for line in genome_file:
+                # Lines from file iteration are never empty, and comparing the
+                # first byte to ord(">") is cheaper than calling startswith().
+                if line[0] == 0x3E:
+                    if chr is not None:
+                        yield chr, sequence_length
+                    chr_match = fasta_header_match(line)
+                    if not chr_match:
+                        raise CampareeUtilsException(f'Cannot parse the chromosome from the fasta line {line}.')
+                    chr = chr_match.group(1).decode("ascii")
+                    sequence_length = 0
+                else:
+                    sequence_length += len(line.rstrip())
+        if chr is not None:
+            yield chr, sequence_length
+
     @staticmethod
     def create_chr_ploidy_data(chr_ploidy_file_path):
         """
@@ -114,24 +322,35 @@ class CampareeUtils:
         :param chr_ploidy_file_path: full path to the chr_ploidy data file
         :return: chr_ploidy_data expressed as a dictionary of dictionary as shown above.
         """
-        df = pd.read_csv(chr_ploidy_file_path, sep='\t')
-        return df.set_index('chr').to_dict(orient='index')
+        # Read chromosome names as strings, even if they all look like numbers.
+        df = pd.read_csv(chr_ploidy_file_path, sep='\t', engine='c', usecols=['chr', 'male', 'female'],
+                         dtype={'chr': str, 'male': int, 'female': int})
+        return {chr: {'male': male, 'female': female}
+                for chr, male, female in zip(df['chr'].tolist(), df['male'].tolist(), df['female'].tolist())}
 
     @staticmethod
     def compare_genome_sequence_lengths(reference_file_path, genome_1_file_path, genome_2_file_path, chromosomes):
-        comparison = {chromosome:[] for chromosome in chromosomes}
-        genome = CampareeUtils.create_genome(reference_file_path)
-        [comparison[chromosome].append(len(sequence)) for chromosome, sequence
-        in genome.items() if chromosome in chromosomes]
-        genome = CampareeUtils.create_genome(genome_1_file_path)
-        for chromosome in chromosomes:
-            seqeunce_length = len(genome.get(chromosome, ''))
-            comparison[chromosome].append(seqeunce_length)
-        genome = CampareeUtils.create_genome(genome_2_file_path)
-        for chromosome in chromosomes:
-            seqeunce_length = len(genome.get(chromosome, ''))
-            comparison[chromosome].append(seqeunce_length)
-        return comparison
+        """
+        Compares the lengths of the given chromosomes/contigs in the reference genome and in the two custom genomes.
+        :param reference_file_path: path to reference genome file (either compressed or not)
+        :param genome_1_file_path: path to first custom genome file (either compressed or not)
+        :param genome_2_file_path: path to second custom genome file (either compressed or not)
+        :param chromosomes: chromosomes/contigs to compare
+        :return: dictionary with the chromosomes/contigs as keys and a list of their [reference genome, genome 1,
+        genome 2] sequence lengths as values. Chromosomes/contigs missing from a genome are given a length of 0.
+        """
+        # Materialize chromosomes once, in case it is a one-shot iterable, and
+        # keep a set of them for fast membership checks.
+        chromosomes = tuple(chromosomes)
+        chromosome_set = frozenset(chromosomes)
+        # Only sequence lengths are needed, so avoid loading whole genomes into
+        # memory, and only keep the lengths of the chromosomes being compared.
+        genome_lengths = [{chr: sequence_length
+                           for chr, sequence_length in CampareeUtils.iter_genome(genome_file_path)
+                           if chr in chromosome_set}
+                          for genome_file_path in (reference_file_path, genome_1_file_path, genome_2_file_path)]
+        return {chromosome: [lengths.get(chromosome, 0) for lengths in genome_lengths]
+                for chromosome in chromosomes}
 
     @staticmethod
     def parse_variant_line(line):
@@ -140,12 +359,12 @@ class CampareeUtils:
         # 1:28494 | C:1 | T:1    TOT=2   0.5,0.5 E=1.0
         if line == '':
             return "DONE", 0, {}
-        entries = line.split('\t')
-        loc_and_vars, total, fractions, entropy = entries
-        loc, *variants = loc_and_vars.split(" | ")
-        chromosome, position = loc.split(":")
+        line_match = CampareeUtils.variant_line_pattern.match(line)
+        if not line_match:
+            raise CampareeUtilsException(f'Cannot parse the variant line {line}.')
+        chromosome, position, variants = line_match.groups()
         position = int(position)
-        variants = {base: int(count) for base, count in [variant.split(":") for variant in variants]}
+        variants = {base: int(count) for base, count in CampareeUtils.variant_pattern.findall(variants)}
         return chromosome, position, variants
 
     @staticmethod
@@ -200,12 +419,10 @@ class CampareeUtils:
             #Print annot file header (note the '#' prefix)
             output_annot_file.write("#" + CampareeUtils.annot_output_format.replace('{', '').replace('}', ''))
 
-            #Regex patterns used to extract individual attributes from the 9th
-            #column in the GTF file (the "attributes" column)
-            txid_pattern = re.compile(r'transcript_id "([^"]+)";')
-            geneid_pattern = re.compile(r'gene_id "([^"]+)";')
-            genesymbol_pattern = re.compile(r'gene_name "([^"]+)";')
-            biotype_pattern = re.compile(r'gene_biotype "([^"]+)";')
+            #Bind search methods of the attribute regex patterns once, since
+            #they are called for every exon in the GTF file.
+            txid_search = CampareeUtils.gtf_txid_pattern.search
+            attributes_findall = CampareeUtils.gtf_attributes_pattern.findall
 
             line_data = [] #List of line fields from current line of gtf
             curr_gtf_tx = "" #transcript ID from current line of gtf
@@ -217,7 +434,7 @@ class CampareeUtils:
             biotype = "None" #Biotype of current transcript
             ex_starts = [] #List of exon start coordinates for current transcript
             ex_stops = [] #List of exon stop coordinates for current transcript
-            ex_count = 1 #Number of exons in current transcript
+            annot_lines = [] #Formatted annotation lines waiting to be written
 
             #Step through GTF until first exon entry (need to prime variables
             #with data from first exon).
@@ -242,21 +459,22 @@ class CampareeUtils:
             strand = line_data[6]
             ex_starts.append(line_data[3])
             ex_stops.append(line_data[4])
-            txid = txid_pattern.search(line_data[8]).group(1)
-            geneid = geneid_pattern.search(line_data[8]).group(1)
-            if genesymbol_pattern.search(line_data[8]):
-                genesymbol = genesymbol_pattern.search(line_data[8]).group(1)
-            if biotype_pattern.search(line_data[8]):
-                biotype = biotype_pattern.search(line_data[8]).group(1)
+            #Reversed so the first occurrence of any repeated attribute wins.
+            attributes = dict(reversed(attributes_findall(line_data[8])))
+            txid = attributes['transcript_id']
+            geneid = attributes['gene_id']
+            genesymbol = attributes.get('gene_name', "None")
+            biotype = attributes.get('gene_biotype', "None")
             chromosomes.add(chrom)
 
             #process the remainder of the GTF file
             for line in gtf_file:
-                line = line.rstrip('\n')
+                #No need to strip the trailing newline, since it only ends up in
+                #the attributes column, which is only searched by regex.
                 line_data = line.split("\t")
 
                 if line_data[2] == "exon":
-                    curr_gtf_tx = txid_pattern.search(line_data[8]).group(1)
+                    curr_gtf_tx = txid_search(line_data[8]).group(1)
 
                     #Check transcript in current line is a new transcript
                     if curr_gtf_tx != txid:
@@ -266,46 +484,34 @@ class CampareeUtils:
                             ex_starts.reverse()
                             ex_stops.reverse()
 
-                        #Format data from previous transcript and write to annotation file
-                        output_annot_file.write(
-                            CampareeUtils.annot_output_format.format(
-                                chrom=chrom,
-                                strand=strand,
-                                txStart=ex_starts[0],
-                                txEnd=ex_stops[-1],
-                                exonCount=ex_count,
-                                exonStarts=','.join(ex_starts),
-                                exonEnds=','.join(ex_stops),
-                                transcriptID=txid,
-                                geneID=geneid,
-                                geneSymbol=genesymbol,
-                                biotype=biotype
+                        #Format data from previous transcript and queue it for
+                        #output to the annotation file
+                        annot_lines.append(
+                            CampareeUtils.annot_output_template % (
+                                chrom, strand, ex_starts[0], ex_stops[-1], len(ex_starts),
+                                ','.join(ex_starts), ','.join(ex_stops), txid, geneid, genesymbol, biotype
                             )
                         )
+                        if len(annot_lines) >= CampareeUtils.annot_lines_per_write:
+                            output_annot_file.writelines(annot_lines)
+                            annot_lines.clear()
 
                         #Load data from new transcript into appropriate variables
                         txid = curr_gtf_tx
                         chrom = line_data[0]
                         strand = line_data[6]
-                        ex_count = 1
                         ex_starts = [line_data[3]]
                         ex_stops = [line_data[4]]
-                        geneid = geneid_pattern.search(line_data[8]).group(1)
-                        if genesymbol_pattern.search(line_data[8]):
-                            genesymbol = genesymbol_pattern.search(line_data[8]).group(1)
-                        else:
-                            genesymbol = "None"
-                        if biotype_pattern.search(line_data[8]):
-                            biotype = biotype_pattern.search(line_data[8]).group(1)
-                        else:
-                            biotype = "None"
+                        attributes = dict(reversed(attributes_findall(line_data[8])))
+                        geneid = attributes['gene_id']
+                        genesymbol = attributes.get('gene_name', "None")
+                        biotype = attributes.get('gene_biotype', "None")
                         chromosomes.add(chrom)
 
                     #This exon is strill from the same transcript.
                     else:
                         ex_starts.append(line_data[3])
                         ex_stops.append(line_data[4])
-                        ex_count += 1
 
             #Finish processing last transcript in GTF file
 
@@ -314,22 +520,15 @@ class CampareeUtils:
                 ex_starts.reverse()
                 ex_stops.reverse()
 
-            #Format data from last transcript and write to annotation file
-            output_annot_file.write(
-                CampareeUtils.annot_output_format.format(
-                    chrom=chrom,
-                    strand=strand,
-                    txStart=ex_starts[0],
-                    txEnd=ex_stops[-1],
-                    exonCount=ex_count,
-                    exonStarts=','.join(ex_starts),
-                    exonEnds=','.join(ex_stops),
-                    transcriptID=txid,
-                    geneID=geneid,
-                    geneSymbol=genesymbol,
-                    biotype=biotype
+            #Format data from last transcript and write it, along with any
+            #other queued transcripts, to annotation file
+            annot_lines.append(
+                CampareeUtils.annot_output_template % (
+                    chrom, strand, ex_starts[0], ex_stops[-1], len(ex_starts),
+                    ','.join(ex_starts), ','.join(ex_stops), txid, geneid, genesymbol, biotype
                 )
             )
+            output_annot_file.writelines(annot_lines)
 
         return chromosomes
 
@@ -343,7 +542,9 @@ class CampareeUtils:
         ----------
         filename : string
             Name of the file to open. If this filename has a '.gz' extension,
-            the function uses the gzip package. If not, it uses open() function.
+            the function pipes the file through an external pigz or gzip process
+            (see GzipSubprocessFile), falling back on the gzip package if neither
+            is installed. If not, it uses open() function.
         mode : string
             Access mode (e.g. 'r' - read, 'w' - write) passed to the open function.
             Note, to open a file in binary mode, need to explicitly end the mode
@@ -369,12 +570,109 @@ class CampareeUtils:
             updated_mode = updated_mode + 't'
 
         if filename.endswith('.gz'):
-            file_pointer = gzip.open(filename=filename, mode=updated_mode)
+            # Decompression/compression is handed off to an external pigz (or,
+            # failing that, gzip) process when one is available, since both are
+            # considerably faster than Python's gzip module and run alongside
+            # the Python code consuming/producing the data.
+            gzip_executable = shutil.which('pigz') or shutil.which('gzip')
+            if gzip_executable and '+' not in updated_mode and 'x' not in updated_mode:
+                file_pointer = GzipSubprocessFile(filename, updated_mode, gzip_executable)
+            else:
+                binary_mode = updated_mode.replace('t', '').replace('b', '') + 'b'
+                gzip_file = gzip.GzipFile(filename=filename, mode=binary_mode)
+                if 'r' in binary_mode:
+                    file_pointer = io.BufferedReader(gzip_file, buffer_size=CampareeUtils.io_buffer_size)
+                else:
+                    file_pointer = io.BufferedWriter(gzip_file, buffer_size=CampareeUtils.io_buffer_size)
+                if 'b' not in updated_mode:
+                    file_pointer = io.TextIOWrapper(file_pointer)
         else:
-            file_pointer = open(file=filename, mode=updated_mode)
+            file_pointer = open(file=filename, mode=updated_mode, buffering=CampareeUtils.io_buffer_size)
 
         return file_pointer
 
+class GzipSubprocessFile:
+    """
+    File object wrapper around a pipe to/from an external pigz or gzip process.
+    Reading streams the file through "<executable> -dc", while writing and
+    appending stream data through "<executable> -c" into the target file.
+    Closing the file waits for the external process to finish and raises a
+    CampareeUtilsException if it failed.
+    """
+
+    # Size of the buffer around the pipe to/from the external process.
+    pipe_buffer_size = 1 << 20
+
+    def __init__(self, filename, mode, executable):
+        """
+        Parameters
+        ----------
+        filename : string
+            Path to the gzipped file.
+        mode : string
+            Access mode, as accepted by open(). Text mode is used unless the
+            mode contains a 'b'.
+        executable : string
+            Path to the pigz or gzip executable.
+
+        """
+        self.filename = filename
+        self.mode = mode
+        self.reading = 'r' in mode
+        self._output_file = None
+
+        if self.reading:
+            # The file is opened here rather than by the external process, so
+            # that a missing or unreadable file raises the usual OSError.
+            with open(filename, 'rb') as input_file:
+                self._process = subprocess.Popen([executable, '-dc'],
+                                                 stdin=input_file,
+                                                 stdout=subprocess.PIPE,
+                                                 bufsize=GzipSubprocessFile.pipe_buffer_size)
+            pipe = self._process.stdout
+        else:
+            self._output_file = open(filename, 'ab' if 'a' in mode else 'wb')
+            self._process = subprocess.Popen([executable, '-c'],
+                                             stdin=subprocess.PIPE,
+                                             stdout=self._output_file,
+                                             bufsize=GzipSubprocessFile.pipe_buffer_size)
+            pipe = self._process.stdin
+
+        self._file = pipe if 'b' in mode else io.TextIOWrapper(pipe)
+
+    def close(self):
+        if self._file.closed:
+            return
+        self._file.close()
+        return_code = self._process.wait()
+        if self._output_file:
+            self._output_file.close()
+        # A reader closed before reaching the end of the file terminates the
+        # external process with a SIGPIPE, which is not an error.
+        if return_code != 0 and not (self.reading and return_code == -signal.SIGPIPE):
+            raise CampareeUtilsException(f"External gzip process for {self.filename} "
+                                         f"failed with exit code {return_code}.")
+
+    def __getattr__(self, name):
+        return getattr(self._file, name)
+
+    def __iter__(self):
+        return iter(self._file)
+
+    def __next__(self):
+        return next(self._file)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            self.close()
+        except Exception:
+            # Do not replace an exception raised within the with block.
+            if exc_type is None:
+                raise
+
 class CampareeException(Exception):
     """Base class for other Camparee exceptions."""
     pass
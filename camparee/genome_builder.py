@@ -85,7 +85,7 @@ class GenomeBuilderStep(AbstractCampareeStep):
                 if chromosome not in self.unpaired_chr_list:
                     continue
                 for line in data:
-                    match = re.match(self.variant_line_pattern, line)
+                    match = self.variant_line_pattern.match(line)
                     variant_chromosome = match.group(1)
                     position = int(match.group(2)) - 1
                     variant = match.group(3).split(' | ')[0].split(":")[0]
@@ -1,4 +1,5 @@
 import collections
+import concurrent.futures
 import itertools
 import os
 import sys
@@ -12,7 +13,362 @@ from camparee.annotation_info import AnnotationInfo
 from camparee.abstract_camparee_step import AbstractCampareeStep
 from camparee.camparee_constants import CAMPAREE_CONSTANTS
 
+def _touched(region_starts, region_ends, block_starts, block_ends):
+    """
+    Find the range of regions touched by each of a batch of alignment blocks.
+
+    Parameters
+    ----------
+    region_starts : numpy.ndarray
+        Sorted starts of the non-overlapping (and non-empty) regions to check the blocks against.
+    region_ends : numpy.ndarray
+        Corresponding ends of the regions.
+    block_starts : numpy.ndarray
+        1-based start of each block.
+    block_ends : numpy.ndarray
+        Inclusive end of each block.
+
+    Returns
+    -------
+    tuple
+        Numpy arrays of the index of the first region each block touches and
+        of the first region after it that the block does not touch.
+
+    """
+    # We may intersect this region, depending on where its end lies
+    # or this could be -1 if we start before all regions
+    last_before = numpy.searchsorted(region_starts, block_starts, side="right") - 1
+    # We definitely do not intersect this region, it starts after our end
+    first_after = numpy.searchsorted(region_starts, block_ends, side="right")
+    # but all between the two, we do intersect. Skip the last one to start before us if there isn't one
+    # or it ends before we start (ends[-1] is harmless to look up, it is only used when last_before >= 0)
+    first_touched = last_before + ((last_before < 0) | (region_ends[last_before] < block_starts))
+    return first_touched, first_after
+
+
+def _merge_blocks(block_starts, block_ends, block_fragments):
+    """
+    Merge the overlapping or adjacent alignment blocks of each fragment, such as where the two reads of a pair
+    overlap, so that their regions are only looked up once.
+
+    Parameters
+    ----------
+    block_starts : numpy.ndarray
+        1-based start of each block.
+    block_ends : numpy.ndarray
+        Inclusive end of each block.
+    block_fragments : numpy.ndarray
+        Number of the fragment each block belongs to.
+
+    Returns
+    -------
+    tuple
+        Numpy arrays of the starts, ends and fragment numbers of the merged
+        blocks, sorted by fragment and then by start.
+
+    """
+    if len(block_starts) == 0:
+        return block_starts, block_ends, block_fragments
+    order = numpy.lexsort((block_starts, block_fragments))
+    starts, ends, fragments = block_starts[order], block_ends[order], block_fragments[order]
+    # Shift each fragment's coordinates past those of the fragments before it, so that the running maximum
+    # of the ends only ever covers the blocks of the current fragment
+    offsets = fragments * (int(ends.max()) + 2)
+    reach = numpy.maximum.accumulate(ends + offsets)
+    # A block starts a new merged block unless it overlaps or touches the blocks before it in the fragment
+    first = numpy.flatnonzero(numpy.concatenate(([True], starts[1:] + offsets[1:] > reach[:-1] + 1)))
+    return starts[first], numpy.maximum.reduceat(ends, first), fragments[first]
+
+
+def _touched_regions(extents, block_starts, block_ends, block_fragments):
+    """
+    Find the regions touched by a batch of alignment blocks, counting each region at most once per fragment.
+
+    Parameters
+    ----------
+    extents : tuple
+        Numpy arrays of the sorted starts and of the ends of the non-overlapping regions to check the blocks against.
+    block_starts : numpy.ndarray
+        1-based start of each block.
+    block_ends : numpy.ndarray
+        Inclusive end of each block.
+    block_fragments : numpy.ndarray
+        Number of the fragment each block belongs to. The blocks must be merged
+        with _merge_blocks(), so that a fragment's blocks are disjoint and in order.
+
+    Returns
+    -------
+    tuple
+        Numpy arrays of the indexes of the touched regions and of the number of
+        fragments touching each of them.
+
+    """
+    region_starts, region_ends = extents
+    if len(region_starts) == 0:
+        return numpy.array([], dtype=numpy.int64), numpy.array([], dtype=numpy.int64)
+
+    first_touched, first_after = _touched(region_starts, region_ends, block_starts, block_ends)
+
+    # A region spanning the gap between two blocks of a fragment is touched by both of them,
+    # count it only with the first one so that each region is counted once per fragment
+    same_fragment = block_fragments[1:] == block_fragments[:-1]
+    first_touched[1:][same_fragment] = numpy.maximum(first_touched[1:][same_fragment], first_after[:-1][same_fragment])
+
+    # Expand each block's range of regions
+    lengths = numpy.maximum(first_after - first_touched, 0)
+    regions = numpy.repeat(first_touched - numpy.cumsum(lengths) + lengths, lengths) + numpy.arange(lengths.sum())
+    return numpy.unique(regions, return_counts=True)
+
+
+class FragmentCounter:
+    """ Counts the read pairs touching each mintron and intergenic region.
+
+    Counts are kept by region index rather than by intron, so that they can be counted in separate processes
+    and added up afterwards.
+    """
+    # Number of alignment blocks to queue up before looking up the regions they touch
+    blocks_per_batch = 1 << 16
+    # Number of reads to cache between sweeps of cached reads whose mate was filtered out
+    unpaired_reads_sweep_interval = 1 << 16
+
+    def __init__(self, mintron_extents_by_chrom, intergenic_extents_by_chrom, forward_read_is_sense):
+        """
+        :param mintron_extents_by_chrom: dictionary of {(chrom, strand) -> (starts, ends)} of the mintrons
+        :param intergenic_extents_by_chrom: dictionary of {chrom -> (starts, ends)} of the intergenic regions
+        :param forward_read_is_sense: whether the forward read is sense, which determines the fragment's strand
+        """
+        self.mintron_extents_by_chrom = mintron_extents_by_chrom
+        self.intergenic_extents_by_chrom = intergenic_extents_by_chrom
+        self.forward_read_is_sense = forward_read_is_sense
+        # (chrom, strand) -> array of the read count of each mintron, where the reads are sense to the mintron
+        self.mintron_read_counts = {contig: numpy.zeros(len(starts), dtype=numpy.int64)
+                                    for contig, (starts, ends) in mintron_extents_by_chrom.items()}
+        # (chrom, strand) -> array of the read count of each mintron, where the reads are antisense to the mintron
+        self.antisense_mintron_read_counts = {contig: numpy.zeros(len(starts), dtype=numpy.int64)
+                                              for contig, (starts, ends) in mintron_extents_by_chrom.items()}
+        # chrom -> array of the read count of each intergenic region
+        self.intergenic_read_counts = {chrom: numpy.zeros(len(starts), dtype=numpy.int64)
+                                       for chrom, (starts, ends) in intergenic_extents_by_chrom.items()}
+
+    def counts(self):
+        """
+        :return: tuple of all the (non-zero) read counts, which can be given to add_counts() of another
+                 FragmentCounter
+        """
+        return ({contig: counts for contig, counts in self.mintron_read_counts.items() if counts.any()},
+                {contig: counts for contig, counts in self.antisense_mintron_read_counts.items() if counts.any()},
+                {chrom: counts for chrom, counts in self.intergenic_read_counts.items() if counts.any()})
+
+    def add_counts(self, mintron_read_counts, antisense_mintron_read_counts, intergenic_read_counts):
+        """
+        Add in the read counts of another FragmentCounter, as returned by its counts() method
+        """
+        for contig, counts in mintron_read_counts.items():
+            self.mintron_read_counts[contig] += counts
+        for contig, counts in antisense_mintron_read_counts.items():
+            self.antisense_mintron_read_counts[contig] += counts
+        for chrom, counts in intergenic_read_counts.items():
+            self.intergenic_read_counts[chrom] += counts
+
+    def count_alignments(self, alignments, coordinate_sorted=False):
+        """
+        Count the fragments from an iterable of alignments, pairing up the reads with their mate
+
+        :param alignments: iterable of pysam.AlignedSegment
+        :param coordinate_sorted: whether the alignments are sorted by position, in which case reads whose mate
+                                  was filtered out are dropped from the cache as soon as we get past their mate
+        """
+        # Blocks of the fragments waiting to be counted, by (chrom, strand) of the fragment:
+        # lists of the block starts, block ends and the fragment number of each block
+        # The same lists are refilled batch after batch
+        pending_blocks = collections.defaultdict(lambda: ([], [], []))
+        # Lists of the (chrom, strand) of the last fragment, most fragments go to the same lists as the previous one
+        last_contig = None
+        blocks = None
+        fragment_number = 0
+        # query name -> ((reference id, start) of the mate, whether the read is reverse, blocks of the read)
+        unpaired_reads = dict()
+        cached_since_sweep = 0
+
+        # The fragment's strand from the reverse and read1 flags of either one of its reads, which tell
+        # whether read 1 was aligned to the reverse strand - depends on whether the forward or reverse reads are 'sense'
+        read1_reverse_strand, read1_forward_strand = ("-", "+") if self.forward_read_is_sense else ("+", "-")
+        strand_flags = pysam.FREVERSE | pysam.FREAD1
+        strand_by_flag = {pysam.FREVERSE | pysam.FREAD1: read1_reverse_strand, # read 1, reverse
+                          pysam.FREVERSE: read1_forward_strand, # read 2, reverse
+                          pysam.FREAD1: read1_forward_strand, # read 1, forward
+                          0: read1_reverse_strand} # read 2, forward
+
+        # Go through all reads, and compare
+        skipped_chromosomes = []
+        for read in alignments:
+            # Test the flag bits directly rather than through the pysam properties, which each decode the flag
+            flag = read.flag
+            # Use only uniquely mapped reads with both pairs mapped
+            if flag & pysam.FUNMAP or not flag & pysam.FPROPER_PAIR or read.get_tag("NH") != 1:
+                continue
+
+            query_name = read.query_name
+            is_reverse = bool(flag & pysam.FREVERSE)
+            try:
+                mate_position, mate_is_reverse, mate_blocks = unpaired_reads[query_name]
+            except KeyError:
+                # mate not cached for processing, so cache this one
+                mate_position = (read.next_reference_id, read.next_reference_start)
+                if coordinate_sorted:
+                    # In a coordinate sorted file a read's mate, if it was kept, turns up by the time we get
+                    # to the mate's position, so reads whose mate was filtered out need not be cached forever
+                    position = (read.reference_id, read.reference_start)
+                    if mate_position < position:
+                        # We are already past the mate, so it was filtered out
+                        continue
+                    cached_since_sweep += 1
+                    if cached_since_sweep >= self.unpaired_reads_sweep_interval:
+                        unpaired_reads = {cached_name: cached for cached_name, cached in unpaired_reads.items()
+                                          if cached[0] >= position}
+                        cached_since_sweep = 0
+                unpaired_reads[query_name] = (mate_position, is_reverse, read.get_blocks())
+                continue
+
+            # Read is paired to 'mate', so we process both together now
+            # So remove the mate from the cache since we're done with it
+            del unpaired_reads[query_name]
+
+            chrom = read.reference_name
+            # Check annotations are available for that chromosome
+            if chrom not in self.intergenic_extents_by_chrom:
+                if chrom not in skipped_chromosomes:
+                    print(f"Alignment from chromosome {chrom} skipped")
+                    skipped_chromosomes.append(chrom)
+                continue
+
+            # According to the SAM file specification, this CAN fail but I don't understand why it would
+            # so just throw this assert in to verify that it doesn't, at least for now
+            assert is_reverse != mate_is_reverse
+
+            # Figure out the fragment's strand - depends on whether the forward or reverse reads are 'sense'
+            strand = strand_by_flag[flag & strand_flags]
+
+            # Queue up the blocks of the fragment, the regions they touch are found a batch at a time
+            contig = (chrom, strand)
+            if contig != last_contig:
+                blocks = pending_blocks[contig]
+                block_starts, block_ends, block_fragments = blocks
+                last_contig = contig
+            for start, end in itertools.chain(read.get_blocks(), mate_blocks):
+                # NOTE: pysam is working in 0-based, half-open coordinates! We are using 1-based
+                block_starts.append(start + 1)
+                block_ends.append(end)
+                block_fragments.append(fragment_number)
+            fragment_number += 1
+
+            if len(block_starts) >= self.blocks_per_batch:
+                self.count_blocks(chrom, strand, blocks)
+                for values in blocks:
+                    values.clear()
+
+        for (chrom, strand), blocks in pending_blocks.items():
+            self.count_blocks(chrom, strand, blocks)
+
+    def count_blocks(self, chrom, strand, blocks):
+        """
+        Accumulate the read counts of all the mintrons and intergenic regions touched by a batch of fragments.
+
+        :param chrom: chromosome the fragments are aligned to
+        :param strand: strand ("+" or "-") the fragments are sense to
+        :param blocks: tuple of lists of the 1-based start, the inclusive end and the fragment number of every
+                       alignment block of the fragments
+        """
+        antisense_strand = "-" if strand == "+" else "+"
+        block_starts, block_ends, block_fragments = _merge_blocks(*(numpy.array(values, dtype=numpy.int64)
+                                                                    for values in blocks))
+
+        # Use get() method to prevent KeyError if any of these data structures
+        # are empty. This can occur for small chromosomes and non-standard
+        # contigs.
+        mintron_extents = self.mintron_extents_by_chrom.get((chrom, strand))
+        antisense_mintron_extents = self.mintron_extents_by_chrom.get((chrom, antisense_strand))
+        intergenic_extents = self.intergenic_extents_by_chrom.get(chrom)
+
+        # If any mintrons were found in the current chromosome/strand
+        if mintron_extents is not None:
+            mintron_indexes, counts = _touched_regions(mintron_extents, block_starts, block_ends, block_fragments)
+            self.mintron_read_counts[chrom, strand][mintron_indexes] += counts
+
+        # If any antisense mintrons were found in the current chromosome/strand
+        if antisense_mintron_extents is not None:
+            antisense_mintron_indexes, counts = _touched_regions(antisense_mintron_extents, block_starts, block_ends, block_fragments)
+            self.antisense_mintron_read_counts[chrom, antisense_strand][antisense_mintron_indexes] += counts
+
+        # If any intergenic regions were found in the current chromosome
+        # (should only be an issue for small contigs, some prokaryotic
+        # genomes, and other less common cases)
+        if intergenic_extents is not None:
+            intergenic_indexes, counts = _touched_regions(intergenic_extents, block_starts, block_ends, block_fragments)
+            self.intergenic_read_counts[chrom][intergenic_indexes] += counts
+
+
+# FragmentCounter that each worker process copies its region lookup tables from, see _init_worker()
+_worker_fragment_counter = None
+
+
+def _init_worker(fragment_counter):
+    """
+    Initializer of the worker processes of IntronQuantificationStep.execute(), passing them the region lookup
+    tables once rather than with every chromosome.
+    """
+    global _worker_fragment_counter
+    _worker_fragment_counter = fragment_counter
+
+
+def _count_chromosome(aligned_file_path, chrom):
+    """
+    Count the fragments aligned to one chromosome of an indexed BAM file, in a worker process
+
+    :return: read counts of the chromosome, as given by FragmentCounter.counts()
+    """
+    fragment_counter = FragmentCounter(_worker_fragment_counter.mintron_extents_by_chrom,
+                                       _worker_fragment_counter.intergenic_extents_by_chrom,
+                                       _worker_fragment_counter.forward_read_is_sense)
+    with pysam.AlignmentFile(aligned_file_path, "rb", check_sq=False) as alignments:
+        fragment_counter.count_alignments(alignments.fetch(chrom), coordinate_sorted=True)
+    return fragment_counter.counts()
+
+
+def _segment_sums(values, indptr):
+    """
+    Sum up the consecutive segments values[indptr[i]:indptr[i+1]], with empty segments summing to 0
+
+    :param values: numpy array of values to sum up
+    :param indptr: numpy array of the boundaries of the segments
+    :return: numpy array of the sum of each segment
+    """
+    sums = numpy.zeros(len(indptr) - 1)
+    nonempty = indptr[:-1] < indptr[1:]
+    if nonempty.any():
+        sums[nonempty] = numpy.add.reduceat(values, indptr[:-1][nonempty])
+    return sums
+
+
+def _available_cpu_count():
+    """
+    :return: number of CPUs this process may run on, which can be less than the CPUs in the machine
+    """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        # Not available on all platforms
+        return os.cpu_count() or 1
+
+
 class IntronQuantificationStep(AbstractCampareeStep):
+    # Buffer size of the output files, and number of lines to join up before each write to them
+    output_buffer_size = 1 << 22
+    output_lines_per_write = 10000
+    # Lines of the intron and intergenic output files
+    transcript_output_template = '%s\t'*5 + '%s\n'
+    intergenic_output_template = '%s\t'*4 + '%s\n'
+
     def __init__(self, log_directory_path, data_directory_path, parameters):
         #TODO: I dont thing the data directory or the log directory are ever
         #      used in the code below. Should we remove them? Or adapt the code
@@ -20,12 +376,15 @@ class IntronQuantificationStep(AbstractCampareeStep):
         self.log_directory_path = log_directory_path
         self.data_directory_path = data_directory_path
         self.info = None
-        self.intron_normalized_antisense_counts = collections.Counter()
-        self.intron_normalized_counts = collections.Counter()
-        self.transcript_intron_antisense_counts = collections.Counter()
-        self.transcript_intron_counts = collections.Counter()
+        # Numpy arrays indexed like self.info.introns
+        self.intron_normalized_antisense_counts = None
+        self.intron_normalized_counts = None
+        # transcript_id -> count
+        self.transcript_intron_antisense_counts = dict()
+        self.transcript_intron_counts = dict()
         self.flank_size = parameters["flank_size"]
-        self.intergenic_read_counts = collections.defaultdict(collections.Counter)
+        # chrom -> array of the read count of each intergenic region, indexed like self.info.intergenics[chrom]
+        self.intergenic_read_counts = dict()
         self.forward_read_is_sense = parameters["forward_read_is_sense"]
 
     def validate(self):
@@ -33,259 +392,198 @@ class IntronQuantificationStep(AbstractCampareeStep):
         return True
 
     def execute(self, aligned_file_path, output_directory, geneinfo_file_path):
-        # (chrom, strand) -> {(transcriptID, intron_number) -> read_count}
-        intron_read_counts = collections.Counter()
-        intron_antisense_read_counts = collections.Counter()
-        # chrom -> {intron -> read count}
-
         # Open BAM file with pysam
         # NOTE: use the check_sq=False flag since sometimes pysam complains erroneously about BAM headers
         # even though the header appears fine in samtools
         print(f"Opening alignment file {aligned_file_path}")
-        with pysam.AlignmentFile(aligned_file_path, "rb") as alignments:
+        # Only the header and index are read here. The alignments are read after the annotation is loaded, either
+        # by worker processes, or by this process with htslib decompression threads. The worker processes are
+        # forked before any htslib threads exist.
+        with pysam.AlignmentFile(aligned_file_path, "rb", check_sq=False) as alignments:
 
             chrom_lengths = dict(zip(alignments.references, alignments.lengths))
 
-            #  Read in the annotation information
-            self.info = AnnotationInfo(geneinfo_file_path, chrom_lengths)
-            print(f"Read in annotation info file {geneinfo_file_path}")
-
-            unpaired_reads = dict()
-
-            # Go through all reads, and compare
-            skipped_chromosomes = []
-            for read in alignments.fetch(until_eof=True):
-                # Use only uniquely mapped reads with both pairs mapped
-                if read.is_unmapped or not read.is_proper_pair or not read.get_tag("NH") == 1:
-                    continue
-
-                try:
-                    mate = unpaired_reads[read.query_name]
-                except KeyError:
-                    # mate not cached for processing, so cache this one
-                    unpaired_reads[read.query_name] = read
-                    continue
-
-                # Read is paired to 'mate', so we process both together now
-                # So remove the mate from the cache since we're done with it
-                del unpaired_reads[read.query_name]
-
-                chrom = read.reference_name
-                # Check annotations are available for that chromosome
+            # The index tells which chromosomes have reads, the annotation of the others needs no region lookups
+            mapped_reads = None
+            if alignments.has_index():
+                mapped_reads = {stats.contig: stats.mapped for stats in alignments.get_index_statistics()
+                                if stats.mapped > 0}
+
+            # A read's mate can only be dropped from the cache early when the reads come in order
+            coordinate_sorted = alignments.header.to_dict().get("HD", {}).get("SO") == "coordinate"
+
+        #  Read in the annotation information
+        self.info = AnnotationInfo(geneinfo_file_path, chrom_lengths, restrict_chroms=mapped_reads)
+        print(f"Read in annotation info file {geneinfo_file_path}")
+
+        fragment_counter = FragmentCounter(self.info.mintron_extents_by_chrom,
+                                           self.info.intergenic_extents_by_chrom,
+                                           self.forward_read_is_sense)
+
+        # Count each chromosome in its own process when the BAM file is indexed and more than one of the
+        # annotated chromosomes has reads
+        chroms = []
+        if mapped_reads is not None:
+            # Biggest chromosomes first, so that the workers finish at about the same time
+            chroms = sorted((chrom for chrom in mapped_reads if chrom in self.info.intergenics),
+                            key=lambda chrom: mapped_reads[chrom], reverse=True)
+        worker_count = min(_available_cpu_count(), len(chroms))
+        if worker_count > 1:
+            for chrom in mapped_reads:
                 if chrom not in self.info.intergenics:
-                    if chrom not in skipped_chromosomes:
-                        print(f"Alignment from chromosome {chrom} skipped")
-                        skipped_chromosomes.append(chrom)
-                    continue
-
-                # According to the SAM file specification, this CAN fail but I don't understand why it would
-                # so just throw this assert in to verify that it doesn't, at least for now
-                assert read.is_reverse != mate.is_reverse
-
-                # Figure out the fragment's strand - depends on whether the forward or reverse reads are 'sense'
-                read1_reverse_aligned = (read.is_reverse and read.is_read1) or (not read.is_reverse and read.is_read2)
-                if self.forward_read_is_sense:
-                    strand = "-" if read1_reverse_aligned else "+"
-                else:
-                    strand = "+" if read1_reverse_aligned else "-"
-                antisense_strand = "-" if strand == "+" else "+"
-
-                # Use get() method to prevent KeyError if any of these data structures
-                # are empty. This can occur for small chromosomes and non-standard
-                # contigs.
-                mintron_starts, mintron_ends = self.info.mintron_extents_by_chrom.get((chrom, strand), [None, None])
-                antisense_mintron_starts, antisense_mintron_ends = self.info.mintron_extents_by_chrom.get((chrom, antisense_strand), [None, None])
-                intergenic_starts, intergenic_ends = self.info.intergenic_extents_by_chrom.get(chrom, [None, None])
-
-                mintrons_touched = set()
-                antisense_mintrons_touched = set()
-                intergenics_touched = set()
-
-                # check what regions our blocks touch
-                for start, end in itertools.chain(read.get_blocks(), mate.get_blocks()):
-                    # NOTE: pysam is working in 0-based, half-open coordinates! We are using 1-based
-                    start = start + 1
-
-                    # If any mintrons were found in the current chromosome/strand
-                    if mintron_starts is not None and mintron_ends is not None:
-                        # We may intersect this mintron, depending on where its end lies
-                        # or this could be -1 if we start before all mintrons
-                        last_mintron_before = numpy.searchsorted(mintron_starts, start, side="right") - 1
-
-                        # We definitely do not intersect this mintron, it starts after our end
-                        first_mintron_after = numpy.searchsorted(mintron_starts, end, side="right")
-                        # but all between the two, we do intersect
-
-                        if last_mintron_before == -1:
-                            # No introns start before us
-                            mintrons_touched.update(range(0, first_mintron_after))
-                        elif mintron_ends[last_mintron_before] >= start:
-                            # We do intersect the last one to start before us
-                            mintrons_touched.update(range(last_mintron_before, first_mintron_after))
-                        else:
-                            # We only start intersecting the first one after that
-                            mintrons_touched.update(range(last_mintron_before + 1, first_mintron_after))
-
-                    # If any antisense mintrons were found in the current chromosome/strand
-                    if antisense_mintron_starts is not None and antisense_mintron_ends is not None:
-                        # Now do the same thing as above for antisense regions
-                        last_antisense_mintron_before = numpy.searchsorted(antisense_mintron_starts, start, side="right") - 1
-                        first_antisense_mintron_after = numpy.searchsorted(antisense_mintron_starts, end, side="right")
-                        if last_antisense_mintron_before == -1:
-                            antisense_mintrons_touched.update(range(0, first_antisense_mintron_after))
-                        elif antisense_mintron_ends[last_antisense_mintron_before] >= start:
-                            antisense_mintrons_touched.update(range(last_antisense_mintron_before, first_antisense_mintron_after))
-                        else:
-                            antisense_mintrons_touched.update(range(last_antisense_mintron_before + 1, first_antisense_mintron_after))
-
-                    # If any intergenic regions were found in the current chromosome
-                    # (should only be an issue for small contigs, some prokaryotic
-                    # genomes, and other less common cases)
-                    if intergenic_starts is not None and intergenic_ends is not None:
-                        # Now do the same thing as above for intergenic regions
-                        last_intergenic_before = numpy.searchsorted(intergenic_starts, start, side="right") - 1
-                        first_intergenic_after = numpy.searchsorted(intergenic_starts, end, side="right")
-                        if last_intergenic_before == -1:
-                            intergenics_touched.update(range(0, first_intergenic_after))
-                        elif intergenic_ends[last_intergenic_before] >= start:
-                            intergenics_touched.update(range(last_intergenic_before, first_intergenic_after))
-                        else:
-                            intergenics_touched.update(range(last_intergenic_before + 1, first_intergenic_after))
-
-                # Accumulate the reads
-                for mintron_index in mintrons_touched:
-                    for intron in self.info.mintrons_by_chrom[chrom, strand][mintron_index].primary_introns:
-                        intron_read_counts[intron] += 1
-
-                for antisense_mintron_index in antisense_mintrons_touched:
-                    for intron in self.info.mintrons_by_chrom[chrom, antisense_strand][antisense_mintron_index].primary_antisense_introns:
-                        intron_antisense_read_counts[intron] += 1
-
-                for intergenic in intergenics_touched:
-                    self.intergenic_read_counts[chrom][intergenic] += 1
-
+                    print(f"Alignment from chromosome {chrom} skipped")
+            with concurrent.futures.ProcessPoolExecutor(max_workers=worker_count,
+                                                        initializer=_init_worker,
+                                                        initargs=(fragment_counter,)) as pool:
+                for counts in pool.map(_count_chromosome, itertools.repeat(aligned_file_path), chroms):
+                    fragment_counter.add_counts(*counts)
+        else:
+            # Decompression of the BAM file is handed off to htslib worker threads
+            with pysam.AlignmentFile(aligned_file_path, "rb", check_sq=False,
+                                     threads=max(1, _available_cpu_count() // 2)) as alignments:
+                fragment_counter.count_alignments(alignments.fetch(until_eof=True), coordinate_sorted)
+
+        # Read counts of each intron, indexed like self.info.introns
+        intron_read_counts = numpy.zeros(len(self.info.introns), dtype=numpy.int64)
+        intron_antisense_read_counts = numpy.zeros(len(self.info.introns), dtype=numpy.int64)
+
+        # Accumulate the reads of each mintron into the introns it is primary for
+        for contig, mintron_read_counts in fragment_counter.mintron_read_counts.items():
+            mintron_indexes, intron_indexes = self.info.primary_intron_ids_by_chrom[contig]
+            numpy.add.at(intron_read_counts, intron_indexes, mintron_read_counts[mintron_indexes])
+
+        for contig, mintron_read_counts in fragment_counter.antisense_mintron_read_counts.items():
+            mintron_indexes, intron_indexes = self.info.primary_antisense_intron_ids_by_chrom[contig]
+            numpy.add.at(intron_antisense_read_counts, intron_indexes, mintron_read_counts[mintron_indexes])
+
+        # Chromosomes without reads were not counted at all
+        self.intergenic_read_counts = {chrom: fragment_counter.intergenic_read_counts.get(chrom, numpy.zeros(len(intergenics), dtype=numpy.int64))
+                                       for chrom, intergenics in self.info.intergenics.items()}
 
         # Normalize reads by effective transcript lengths
-        for intron, count in intron_read_counts.items():
-            effective_count = count / intron.effective_length * 1000 # FPK (fragments per kilo-base)
-            self.intron_normalized_counts[intron] = effective_count
-            # TODO: is this the right normalization factor for antisense reads?
-            #  currently use the total length of all antisense mintrons, but this seems wrong....
-            antisense_count = intron_antisense_read_counts[intron]
-            if antisense_count > 0:
-                self.intron_normalized_antisense_counts[intron] = antisense_count / intron.antisense_effective_length * 1000
+        sense = intron_read_counts > 0
+        self.intron_normalized_counts = numpy.zeros(len(self.info.introns))
+        self.intron_normalized_counts[sense] = (intron_read_counts[sense] / self.info.intron_effective_lengths[sense]
+                                                * 1000) # FPK (fragments per kilo-base)
+        # TODO: is this the right normalization factor for antisense reads?
+        #  currently use the total length of all antisense mintrons, but this seems wrong....
+        antisense = sense & (intron_antisense_read_counts > 0)
+        self.intron_normalized_antisense_counts = numpy.zeros(len(self.info.introns))
+        self.intron_normalized_antisense_counts[antisense] = (intron_antisense_read_counts[antisense]
+                                                              / self.info.intron_antisense_effective_lengths[antisense]
+                                                              * 1000)
 
         # Now remove counts from non-primary introns from mintrons, under the assumption that
         # if two introns overlap, we want to "subtract out" one of them from the overlap
         # We process introns in order of their transcript start: the idea being that we are modifying their
         # intron counts, so we had better be consistent as we process, going from 5' to 3' ends
-        for contig, transcripts in self.info.transcripts_by_chrom.items():
-            for transcript in transcripts:
-                for intron in transcript.introns:
-                    count = self.intron_normalized_counts.get(intron, 0)
-                    if count == 0:
-                        continue
-
-                    for mintron in intron.mintrons:
-                        if intron not in mintron.primary_introns:
-                            for other_intron in mintron.primary_introns:
-                                other_counts = self.intron_normalized_counts[other_intron]
-                                # Remove the double-counts but never give negative expression
-                                self.intron_normalized_counts[other_intron] = min(other_counts - count, 0)
-
-                    # Same for anti-sense
-                    antisense_count = self.intron_normalized_counts.get(intron, 0)
-                    for antisense_mintron in intron.antisense_mintrons:
-                        if intron not in antisense_mintron.primary_antisense_introns:
-                            for other_intron in antisense_mintron.primary_antisense_introns:
-                                other_counts = self.intron_normalized_antisense_counts[other_intron]
-                                # Remove the double-counts but never give negative expression
-                                self.intron_normalized_antisense_counts[other_intron] = min(other_counts - antisense_count, 0)
+        normalized_counts = self.intron_normalized_counts.tolist()
+        for intron_index, other_intron_indexes in self.info.sense_conflicts.items():
+            count = normalized_counts[intron_index]
+            if count == 0:
+                continue
+            for other_intron_index in other_intron_indexes:
+                # Remove the double-counts but never give negative expression
+                normalized_counts[other_intron_index] = max(normalized_counts[other_intron_index] - count, 0)
+        self.intron_normalized_counts = numpy.array(normalized_counts, dtype=numpy.float64)
+
+        # Same for anti-sense
+        normalized_antisense_counts = self.intron_normalized_antisense_counts.tolist()
+        for intron_index, other_intron_indexes in self.info.antisense_conflicts.items():
+            antisense_count = normalized_antisense_counts[intron_index]
+            if antisense_count == 0:
+                continue
+            for other_intron_index in other_intron_indexes:
+                # Remove the double-counts but never give negative expression
+                normalized_antisense_counts[other_intron_index] = max(normalized_antisense_counts[other_intron_index] - antisense_count, 0)
+        self.intron_normalized_antisense_counts = numpy.array(normalized_antisense_counts, dtype=numpy.float64)
 
         # Transcript-level intron quantifications
-        for transcript_id, transcript in self.info.transcripts.items():
-            # flanks are first-and-last introns
-            # But for now we do not use them to quantify the total transcript-level
-            # intron counts since they are not really introns but are very long and so
-            # throw off the intron length normalization
-            non_flank_introns = transcript.introns[1:-1]
-            sense_counts = 0
-            antisense_counts = 0
-            total_length = 0
-            for intron in non_flank_introns:
-                # We use normalized_counts here and then "unnormalize" them by effective length since we have
-                # already performed the correction of the above section (removing non-primary intron counts)
-                sense_counts  += self.intron_normalized_counts[intron] * intron.effective_length
-                antisense_counts  += self.intron_normalized_antisense_counts[intron] * intron.effective_length
-                total_length += intron.effective_length
-
-            if total_length == 0:
-                self.transcript_intron_counts[transcript_id] = 0
-                self.transcript_intron_antisense_counts[transcript_id] = 0
-            else:
-                self.transcript_intron_counts[transcript_id] = sense_counts / total_length
-                self.transcript_intron_antisense_counts[transcript_id] = antisense_counts / total_length
+        # flanks are first-and-last introns
+        # But for now we do not use them to quantify the total transcript-level
+        # intron counts since they are not really introns but are very long and so
+        # throw off the intron length normalization, so they are left out of transcript_intron_indices
+        # We use normalized_counts here and then "unnormalize" them by effective length since we have
+        # already performed the correction of the above section (removing non-primary intron counts)
+        indices, indptr = self.info.transcript_intron_indices, self.info.transcript_intron_indptr
+        effective_lengths = self.info.intron_effective_lengths[indices]
+        total_lengths = _segment_sums(effective_lengths, indptr)
+        sense_counts = _segment_sums(self.intron_normalized_counts[indices] * effective_lengths, indptr)
+        antisense_counts = _segment_sums(self.intron_normalized_antisense_counts[indices] * effective_lengths, indptr)
+        has_length = total_lengths > 0
+        sense_counts[has_length] /= total_lengths[has_length]
+        antisense_counts[has_length] /= total_lengths[has_length]
+        # Transcripts without any length get a count of (integer) 0
+        self.transcript_intron_counts = {transcript_id: count if length else 0 for transcript_id, count, length
+                                         in zip(self.info.transcript_ids, sense_counts.tolist(), has_length.tolist())}
+        self.transcript_intron_antisense_counts = {transcript_id: count if length else 0 for transcript_id, count, length
+                                                   in zip(self.info.transcript_ids, antisense_counts.tolist(), has_length.tolist())}
 
         # Write out the results to output file
-        # SENSE INTRON OUTPUT
-        output_file_path = os.path.join(output_directory, CAMPAREE_CONSTANTS.INTRON_OUTPUT_FILENAME)
-        with open(output_file_path, "w") as output_file:
-            output_file.write("#gene_id\ttranscript_id\tchr\tstrand\ttranscript_intron_reads_FPK\tintron_reads_FPK\n")
-            # take transcripts from all chromosomes and combine them, sorting by gene id and then transcript id
-            transcript_ids = sorted((transcript.gene.gene_id, id, transcript) for id, transcript in self.info.transcripts.items())
-            for (gene_id, transcript_id, transcript) in transcript_ids:
-
-                total_count = self.transcript_intron_counts[transcript_id]
-                intron_counts = [str(self.intron_normalized_counts[intron]) for intron in transcript.introns]
-
-
-                output_file.write('\t'.join([gene_id,
-                                             transcript_id,
-                                             transcript.chrom,
-                                             transcript.strand,
-                                             str(total_count),
-                                             ','.join(intron_counts),
-                                            ]) + '\n')
+        # take transcripts from all chromosomes and combine them, sorting by gene id and then transcript id
+        transcript_ids = sorted((transcript.gene.gene_id, id, transcript) for id, transcript in self.info.transcripts.items())
 
-        # ANTISENSE INTRON OUTPUT
-        output_file_path = os.path.join(output_directory, CAMPAREE_CONSTANTS.INTRON_OUTPUT_ANTISENSE_FILENAME)
-        with open(output_file_path, "w") as output_file:
-            output_file.write("#gene_id\ttranscript_id\tchr\tstrand\ttranscript_intron_reads_FPK\tintron_reads_FPK\n")
-            # take transcripts from all chromosomes and combine them, sorting by gene id and then transcript id
-            transcript_ids = sorted((transcript.gene.gene_id, id, transcript) for id, transcript in self.info.transcripts.items())
+        # SENSE AND ANTISENSE INTRON OUTPUT
+        output_file_path = os.path.join(output_directory, CAMPAREE_CONSTANTS.INTRON_OUTPUT_FILENAME)
+        output_antisense_file_path = os.path.join(output_directory, CAMPAREE_CONSTANTS.INTRON_OUTPUT_ANTISENSE_FILENAME)
+        with open(output_file_path, "w", buffering=self.output_buffer_size) as output_file, \
+                open(output_antisense_file_path, "w", buffering=self.output_buffer_size) as output_antisense_file:
+            header = "#gene_id\ttranscript_id\tchr\tstrand\ttranscript_intron_reads_FPK\tintron_reads_FPK\n"
+            output_file.write(header)
+            output_antisense_file.write(header)
+            # Format each intron count only once, a transcript's introns are consecutive in self.info.introns
+            intron_counts = [str(count or 0) for count in normalized_counts]
+            intron_antisense_counts = [str(count or 0) for count in normalized_antisense_counts]
+            lines = []
+            antisense_lines = []
             for (gene_id, transcript_id, transcript) in transcript_ids:
 
-                total_count = self.transcript_intron_antisense_counts[transcript_id]
-                intron_counts = [str(self.intron_normalized_antisense_counts[intron]) for intron in transcript.introns]
-
-
-                output_file.write('\t'.join([gene_id,
-                                             transcript_id,
-                                             transcript.chrom,
-                                             transcript.strand,
-                                             str(total_count),
-                                             ','.join(intron_counts),
-                                            ]) + '\n')
+                chrom, strand = transcript.chrom, transcript.strand
+                first_intron, last_intron = transcript.introns[0].index, transcript.introns[-1].index + 1
+
+                lines.append(self.transcript_output_template % (gene_id,
+                                                                transcript_id,
+                                                                chrom,
+                                                                strand,
+                                                                self.transcript_intron_counts[transcript_id],
+                                                                ','.join(intron_counts[first_intron:last_intron])))
+                antisense_lines.append(self.transcript_output_template % (gene_id,
+                                                                          transcript_id,
+                                                                          chrom,
+                                                                          strand,
+                                                                          self.transcript_intron_antisense_counts[transcript_id],
+                                                                          ','.join(intron_antisense_counts[first_intron:last_intron])))
+                if len(lines) >= self.output_lines_per_write:
+                    output_file.writelines(lines)
+                    output_antisense_file.writelines(antisense_lines)
+                    lines.clear()
+                    antisense_lines.clear()
+            output_file.writelines(lines)
+            output_antisense_file.writelines(antisense_lines)
 
         # TODO: do we need to normalize intergenic regions?
         #   Not clear that just dividing by their length is right since usually you have just
         #   bits and pieces expressed throughout
         output_intergenic_file_path = os.path.join(output_directory, CAMPAREE_CONSTANTS.INTERGENIC_OUTPUT_FILENAME)
-        with open(output_intergenic_file_path, "w") as output_file:
+        with open(output_intergenic_file_path, "w", buffering=self.output_buffer_size) as output_file:
             output_file.write("#chromosome\tintergenic_region_number\tstart\tend\treads_FPK\n")
             # take transcripts from all chromosomes and combine them, sorting by gene id and then transcript id
             chroms_sorted = sorted(self.info.intergenics.keys())
+            lines = []
             for chrom in chroms_sorted:
                 intergenics = self.info.intergenics[chrom]
-                for i, intergenic in enumerate(intergenics):
-                    count = self.intergenic_read_counts[chrom][i]
-
-                    output_file.write('\t'.join([chrom,
-                                                 str(i),
-                                                 str(intergenic.start),
-                                                 str(intergenic.end),
-                                                 str(count),
-                                                ]) + '\n')
+                counts = self.intergenic_read_counts[chrom].tolist()
+                for i, (intergenic, count) in enumerate(zip(intergenics, counts)):
+
+                    lines.append(self.intergenic_output_template % (chrom,
+                                                                    i,
+                                                                    intergenic.start,
+                                                                    intergenic.end,
+                                                                    count))
+                    if len(lines) >= self.output_lines_per_write:
+                        output_file.writelines(lines)
+                        lines.clear()
+            output_file.writelines(lines)
 
     def get_commandline_call(self, aligned_file_path, output_directory, geneinfo_file_path):
         """
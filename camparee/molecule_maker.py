@@ -164,7 +164,7 @@ class MoleculeMakerStep(AbstractCampareeStep):
                 gene, transcript, chrom, strand, transcript_intron_reads_FPK, intron_reads_FPK = line.strip().split("\t")
 
                 transcript_intron_quants[transcript] = float(transcript_intron_reads_FPK)
-                intron_quants[transcript] = [float(quant) for quant in intron_reads_FPK.split(",")]
+                intron_quants[transcript] = list(map(float, intron_reads_FPK.split(",")))
 
         return transcript_intron_quants, intron_quants
 
@@ -299,7 +299,7 @@ class TranscriptomeFastaPreparationStep(AbstractCampareeStep):
         for exon_location in self.exon_location_list:
 
             # Extract the chromosome, start and end from the exon location string
-            exon_info_match = re.search(self.exon_info_pattern, exon_location)
+            exon_info_match = self.exon_info_pattern.search(exon_location)
             chromosome = exon_info_match.group(1)
             exon_start = int(exon_info_match.group(2))
             exon_end = int(exon_info_match.group(3))
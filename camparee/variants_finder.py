@@ -79,11 +79,11 @@ class VariantsFinderStep(AbstractCampareeStep):
         :param sequence: raw sequence string from read
         :return: tuple of modified cigar and sequence strings (sans clips)
         """
-        clip_at_start = re.search(self.clip_at_start_pattern, cigar)
+        clip_at_start = self.clip_at_start_pattern.search(cigar)
         if clip_at_start:
-            cigar = re.sub(self.clip_at_start_pattern, "", cigar)
+            cigar = self.clip_at_start_pattern.sub("", cigar)
             sequence = sequence[int(clip_at_start.group(1)):]
-        cigar = re.sub(self.clip_at_end_pattern, "", cigar)
+        cigar = self.clip_at_end_pattern.sub("", cigar)
         return cigar, sequence
 
     def call_variants(self, chromosome, reads):
@@ -192,7 +192,7 @@ class VariantsFinderStep(AbstractCampareeStep):
                 current_read_components.append((cigar, sequence))
 
             # Iterate over the variant types and lengths in the cigar string
-            for match in re.finditer(self.variant_pattern, cigar):
+            for match in self.variant_pattern.finditer(cigar):
                 length = int(match.group(1))
                 read_type = match.group(2)
 
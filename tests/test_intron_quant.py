@@ -0,0 +1,44 @@
+import numpy
+
+from camparee.annotation_info import AnnotationInfo
+from camparee.intron_quant import FragmentCounter, _merge_blocks, _touched_regions
+
+
+ANNOTATION = ("#chrom\tstrand\ttxStart\ttxEnd\texonCount\texonStarts\texonEnds\ttranscriptID\tgeneID\tgeneSymbol\tbiotype\n"
+              "1\t+\t3000\t6000\t2\t3000,5000\t3500,6000\tT1\tG1\tNG1\tprotein_coding\n")
+
+
+def test_touched_regions_counts_each_fragment_once():
+    rng = numpy.random.default_rng(0)
+    for _ in range(200):
+        # Non-overlapping regions, with gaps between some of them
+        bounds = numpy.sort(rng.choice(numpy.arange(1, 1000), size=2 * int(rng.integers(1, 10)), replace=False))
+        region_starts, region_ends = bounds[0::2], bounds[1::2]
+        fragment_count = int(rng.integers(1, 10))
+        block_fragments = rng.integers(0, fragment_count, size=20)
+        block_starts = rng.integers(1, 1100, size=20)
+        block_ends = block_starts + rng.integers(0, 100, size=20)
+
+        expected = numpy.zeros(len(region_starts), dtype=numpy.int64)
+        for fragment in range(fragment_count):
+            in_fragment = block_fragments == fragment
+            expected += [bool(((block_starts[in_fragment] <= end) & (block_ends[in_fragment] >= start)).any())
+                         for start, end in zip(region_starts, region_ends)]
+
+        regions, counts = _touched_regions((region_starts, region_ends),
+                                           *_merge_blocks(block_starts, block_ends, block_fragments))
+        found = numpy.zeros(len(region_starts), dtype=numpy.int64)
+        found[regions] = counts
+        assert (found == expected).all()
+
+
+def test_count_blocks_read_past_chromosome_end(tmp_path):
+    geneinfo_file_path = tmp_path / "annotation.txt"
+    geneinfo_file_path.write_text(ANNOTATION)
+    info = AnnotationInfo(str(geneinfo_file_path), {"1": 10000})
+    assert [(intergenic.start, intergenic.end) for intergenic in info.intergenics["1"]] == [(1, 1499), (7501, 10000)]
+
+    fragment_counter = FragmentCounter(info.mintron_extents_by_chrom, info.intergenic_extents_by_chrom, True)
+    # The first fragment's block ends past the end of the chromosome
+    fragment_counter.count_blocks("1", "+", ([9950, 100], [20100, 200], [0, 1]))
+    assert fragment_counter.intergenic_read_counts["1"].tolist() == [1, 1]